@@ -19,11 +19,15 @@
 #
 #         List CPU Input Point Coils: ./click_mb_scanner.py <ip> X0
 #         List Data Float Registers:  ./click_mb_scanner.py <ip> DF
+#         Log Values to a File:       ./click_mb_scanner.py <ip> DF --log-file df.bin
+#         Poll Values:                ./click_mb_scanner.py <ip> DF --daemon --interval 1.0
 #
 ######################################################
 
-import os,sys,time,struct
-from pymodbus.client import ModbusTcpClient as ModbusClient
+import os,sys,time,struct,asyncio,collections,argparse
+import pymodbus
+from pymodbus.client import AsyncModbusTcpClient as ModbusClient
+from pymodbus.exceptions import ModbusException,ConnectionException
 
 # Memory Types
 type_names = {
@@ -142,89 +146,327 @@ reg_sizes = {
     'TXT':2
 }
 
-# Command Line Variables
-if ((len(sys.argv) < 2) or (len(sys.argv) > 3)): 
-    print("Check Readme for Usage")
-    sys.exit()
-plc_ip   = sys.argv[1]
-plc_port = 502
-if (len(sys.argv) > 2): query_type = sys.argv[2]
-if (plc_ip == 'list' or query_type == 'list'):
-    for e in type_names.keys():
-        print('%s: %s'%(e,type_names[e]))
-    sys.exit()
-
-with ModbusClient(plc_ip, retries=3, retry_on_empty=True) as client:
-    # Get Coils
-    if (query_type in coil_keys):
-        start_addr = coil_start_addrs[query_type]
-        count = type_ranges[query_type][1]
-        # C type has too many coils, split it up
-        if (query_type == 'C'):
-            rfull = []
-            rfull.extend((client.read_coils(start_addr,1000,unit=0x01)).bits)
-            rfull.extend((client.read_coils(1000,1000,unit=0x01)).bits)
-            for e in range(len(rfull)):
-                print('%s%s : %s'%(query_type,e+1,rfull[e]))
+# Modbus Request Limits
+# The Modbus spec allows up to 125 registers per read (FC03/FC04)
+# and up to 2000 bits per read (FC01/FC02)
+# Lower these with --max-read-registers/--max-read-bits for PLCs that
+# reject full size requests
+max_read_registers = 125
+max_read_bits      = 2000
+Limits = collections.namedtuple('Limits','max_read_registers max_read_bits')
+default_limits = Limits(max_read_registers,max_read_bits)
+
+# Modbus Unit ID
+# The deprecated unit= keyword is slave= in pymodbus 3.x and device_id=
+# from 3.10, built once and passed to every read
+# NOTE: reads go through the client read_* calls rather than a pool of
+# prebuilt requests sent with client.execute(), the request constructors
+# and execute() signature change between pymodbus 3.x releases
+pymodbus_version = tuple([int(v) for v in pymodbus.__version__.split('.')[:2]])
+if (pymodbus_version >= (3,10)):
+    unit_kwargs = {'device_id':0x01}
+else:
+    unit_kwargs = {'slave':0x01}
+
+# Register types read one register per value, printed as decimal or hex
+_INT_BLOCK_TYPES = frozenset({'DS','TD','SD'})
+_HEX_BLOCK_TYPES = frozenset({'DH','TXT'})
+
+# Types read with FC=02 (discrete inputs) and FC=04 (input registers) per
+# the exported Modbus map, the rest are read with FC=01 and FC=03
+_DISCRETE_INPUT_TYPES = frozenset([e for e in coil_keys if e[0] == 'X'] + ['T','CT','SC'])
+_INPUT_REGISTER_TYPES = frozenset({'XD','SD'})
+
+# Module 0 points are numbered 001-016 and 021-036 but sit on 32
+# contiguous bits
+_MODULE0_TYPES = frozenset({'X0','Y0'})
+
+# Memory Table
+# One entry per memory type built from the tables above so a scan only
+# looks its type up once
+#   kind:        bit, int, hex, uint32, or float
+#   step:        registers per value as read (INT and hex values are
+#                read one register at a time)
+#   reader_attr: client read function for the type
+MemSpec = collections.namedtuple('MemSpec','kind start lo hi step reader_attr')
+MEM_TABLE = {}
+for e in coil_keys:
+    if (e in _DISCRETE_INPUT_TYPES):
+        reader_attr = 'read_discrete_inputs'
+    else:
+        reader_attr = 'read_coils'
+    MEM_TABLE[e] = MemSpec('bit',coil_start_addrs[e],type_ranges[e][0],type_ranges[e][1],1,reader_attr)
+for e in reg_keys:
+    if (e in _INT_BLOCK_TYPES):
+        kind = 'int'
+    elif (e in _HEX_BLOCK_TYPES):
+        kind = 'hex'
+    elif (e == 'DF'):
+        kind = 'float'
+    else:
+        kind = 'uint32'
+    if (e in _INT_BLOCK_TYPES or e in _HEX_BLOCK_TYPES):
+        step = 1
+    else:
+        step = reg_sizes[e]
+    if (e in _INPUT_REGISTER_TYPES):
+        reader_attr = 'read_input_registers'
+    else:
+        reader_attr = 'read_holding_registers'
+    MEM_TABLE[e] = MemSpec(kind,reg_start_addrs[e],type_ranges[e][0],type_ranges[e][1],step,reader_attr)
+
+# Register Decoders
+# Structs packing the registers and unpacking the values of every memory
+# type that is split into values, compiled once for a full read of the type
+decoders = {}
+for e,spec in MEM_TABLE.items():
+    if (spec.kind == 'uint32'):
+        fmt = 'I'
+    elif (spec.kind == 'float'):
+        fmt = 'f'
+    else:
+        continue
+    n = spec.hi - spec.lo + 1
+    decoders[e] = (struct.Struct('>%dH'%(n * spec.step)),struct.Struct('>%d%s'%(n,fmt)))
+
+# Decode Scratch Buffer
+# Sized once for the largest memory type that is split into values so
+# decoding reuses the same buffer instead of allocating one per scan
+scratch = bytearray(max([pack.size for pack,unpack in decoders.values()]))
+
+# Decode Registers
+# Returned registers contain two byte values, pack them into the big
+# endian scratch buffer and decode every value with a single unpack call
+def decode_registers(query_type,regs):
+    pack,unpack = decoders[query_type]
+    pack.pack_into(scratch,0,*regs)
+    return unpack.unpack_from(scratch,0)
+
+# Read Blocks
+# Reads count registers or bits a block at a time and returns them in
+# order, a block the PLC answers with an exception response is reported
+# and filled with None so the values after it keep their place. I/O and
+# connection errors end the scan for run() to report. A block rejected
+# with Illegal Data Value (too many values asked for) is read again in
+# halves that stay a multiple of step
+# NOTE: pymodbus holds a lock on the connection from sending a request
+# until its response arrives, so the blocks are read one after another
+async def read_blocks(reader,query_type,start_addr,count,block_size,attr,step=1):
+    rfull = []
+    for b in range(0,count,block_size):
+        a = start_addr + b
+        n = min(block_size,count - b)
+        r = await reader(a,count=n,**unit_kwargs)
+        if (r.isError() and getattr(r,'exception_code',None) == 3 and n > step):
+            half = (n // 2) - ((n // 2) % step)
+            rfull.extend(await read_blocks(reader,query_type,a,half,half,attr,step))
+            rfull.extend(await read_blocks(reader,query_type,a+half,n-half,n-half,attr,step))
+            continue
+        if r.isError():
+            sys.stderr.write('%s read of %d at 0x%04x failed: %s\n'%(query_type,n,a,r))
+            rfull.extend([None] * n)
+        elif (len(getattr(r,attr)) < n):
+            sys.stderr.write('%s read of %d at 0x%04x failed: only %d returned\n'%(query_type,n,a,len(getattr(r,attr))))
+            rfull.extend([None] * n)
         else:
-            if (query_type[0] == 'X'):
-                r = client.read_discrete_inputs(start_addr,count,unit=0x01)
-            else:
-                r = client.read_coils(start_addr,count,unit=0x01)
-            for b in range(1,count):
-                if (query_type[0] == 'X' or query_type[0] == 'Y'):
-                    print('%s%02d : %s'%(query_type,b,r.bits[b]))
-                else:
-                    print('%s%s : %s'%(query_type,b,r.bits[b]))
+            # Bits come back padded out to a full byte
+            rfull.extend(getattr(r,attr)[:n])
+    return rfull
+
+# Get Coils
+# Returns the first value number and the values for a coil memory type
+async def get_coils(client,query_type,limits=default_limits):
+    spec       = MEM_TABLE[query_type]
+    start_addr = spec.start
+    count      = spec.hi
+    reader     = getattr(client,spec.reader_attr)
+    # Module 0 has no points 017-020 so four less bits are read
+    if (query_type in _MODULE0_TYPES):
+        count = count - 4
+
+    # Query a block at a time, split only when a type has more coils
+    # than max_read_bits
+    rfull = await read_blocks(reader,query_type,start_addr,count,limits.max_read_bits,'bits')
+    if (query_type in _MODULE0_TYPES):
+        # Leave 017-020 empty so bits 16-31 are numbered 021-036
+        rfull = rfull[:16] + [None] * 4 + rfull[16:]
+    return 1,rfull
+
+# Get Registers
+# Returns the first value number and the values for a register memory type,
+# quiet skips decoding and returns the raw registers
+async def get_registers(client,query_type,quiet=False,limits=default_limits):
+    spec       = MEM_TABLE[query_type]
+    start_addr = spec.start
+    reader     = getattr(client,spec.reader_attr)
+    name_cnt   = spec.lo
+    reg_count  = (spec.hi - spec.lo + 1) * spec.step
+
+    # Query a block at a time, blocks are a multiple of the register size so no value is split
+    # across two requests
+    block_size = limits.max_read_registers - (limits.max_read_registers % spec.step)
+    rfull = await read_blocks(reader,query_type,start_addr,reg_count,block_size,'registers',spec.step)
+
+    if quiet:
+        return name_cnt,rfull
+    # uint32 values are split from their register pairs on this side
+    # DF values are floats and need to be converted. 
+    # Bytes to Float Example: https://gregstoll.com/~gregstoll/floattohex/
+    # NOTE: there are some rounding differences in the PLC, not sure why
+    if (query_type in decoders):
+        values = decode_registers(query_type,[0 if v is None else v for v in rfull])
+        # Drop the values decoded from the fill of a failed block
+        return name_cnt,[None if rfull[i * spec.step] is None else v for i,v in enumerate(values)]
+    return name_cnt,rfull
+
+# Format Lines
+# Returns the text output lines for the values of a memory type
+def format_lines(query_type,kind,first,values):
+    if (kind == 'int'):
+        # Print decimal values as decimal
+        line_fmt = '%s%s : %d'
+    elif (kind == 'hex'):
+        # Print byte values as hex
+        line_fmt = '%s%s : 0x%x'
+    elif (kind == 'float'):
+        line_fmt = '%s%s : %04f'
+    elif (kind == 'bit' and (query_type[0] == 'X' or query_type[0] == 'Y')):
+        line_fmt = '%s%02d : %s'
+    else:
+        line_fmt = '%s%s : %s'
+    return [line_fmt%(query_type,first+i,v) for i,v in enumerate(values) if v is not None]
+
+# Binary Log Records
+# Each scan is logged as a header of a little endian float64 UNIX
+# timestamp and uint32 record count, followed by its records. Each
+# record is a little endian uint16 value number followed by the value
+# itself packed as its data kind
+record_header = struct.Struct('<dI')
+record_fmts = {
+    'bit'   :'B',
+    'int'   :'H',
+    'hex'   :'H',
+    'uint32':'I',
+    'float' :'f'
+}
+
+# Write Records
+# Pack the header and every value read of a memory type and write them
+# with a single call
+def write_records(log,kind,first,values):
+    rec = []
+    for i,v in enumerate(values):
+        if v is not None:
+            rec.append(first+i)
+            rec.append(v)
+    n = len(rec) // 2
+    log.write(record_header.pack(time.time(),n) + struct.pack('<' + ('H' + record_fmts[kind]) * n,*rec))
+
+# Scan
+# Query the PLC for one memory type and write out the values,
+# quiet only reads the values to check the PLC answers
+async def scan(client,query_type,log=sys.stdout,binary=False,quiet=False,limits=default_limits):
+    spec = MEM_TABLE[query_type]
+    # Get Coils
+    if (spec.kind == 'bit'):
+        first,values = await get_coils(client,query_type,limits)
     # Get Registers
-    if (query_type in reg_keys):
-        start_addr = reg_start_addrs[query_type]
-        count      = type_ranges[query_type][1]  
-        name_cnt   = type_ranges[query_type][0]
-
-        # Manage INT values by querying a block at a time
-        if (query_type in ['DS','TD','SD','DH','TXT']):
-            block_size = 100
-            curr_block = 0
-            while (curr_block <= count): 
-                r = client.read_holding_registers(start_addr+curr_block,100,unit=0x01)
-                if r.registers:
-                    for br in r.registers:
-                        if (query_type in ['DS','TD','SD']):
-                            # Print decimal values as decimal
-                            print('%s%s : %d'%(query_type,name_cnt,br))
-                        else:
-                            # Print byte values as hex
-                            print('%s%s : 0x%x'%(query_type,name_cnt,br))
-                        name_cnt = name_cnt + 1
-                curr_block = curr_block + block_size
+    else:
+        first,values = await get_registers(client,query_type,quiet,limits)
+    # Nothing to write when every block of the scan failed
+    if (quiet or all([v is None for v in values])):
+        return
+    # Write the values out once at the end of the scan
+    if binary:
+        write_records(log,spec.kind,first,values)
+    else:
+        log.write('\n'.join(format_lines(query_type,spec.kind,first,values)) + '\n')
+
+# Run
+# Connect to the PLC and scan it, daemon keeps the connection open and
+# scans again every interval seconds. A failed scan is reported and the
+# daemon reconnects and carries on, otherwise the exit status is returned
+async def run(plc_ip,query_type,log=sys.stdout,binary=False,quiet=False,daemon=False,interval=1.0,port=502,limits=default_limits):
+    client = ModbusClient(plc_ip, port=port, retries=3)
+    try:
+        while True:
+            start = time.monotonic()
+            try:
+                if (not client.connected and not await client.connect()):
+                    raise ConnectionException('unable to connect to %s:%d'%(plc_ip,port))
+                await scan(client,query_type,log,binary,quiet,limits)
+                log.flush()
+            except (ModbusException,asyncio.TimeoutError,OSError) as err:
+                sys.stderr.write('%s scan failed: %s\n'%(query_type,err))
+                if not daemon:
+                    return 1
+                # Drop the connection so the next scan reconnects
+                client.close()
+            if not daemon:
+                return 0
+            await asyncio.sleep(max(0,interval - (time.monotonic() - start)))
+    finally:
+        client.close()
+
+# Quiet Output
+# Returns True when stdout goes to the null device and nobody will see
+# the values
+def stdout_is_null():
+    if sys.stdout.isatty():
+        return False
+    try:
+        return os.path.samestat(os.fstat(sys.stdout.fileno()),os.stat(os.devnull))
+    except (OSError,ValueError):
+        return False
+
+# Command Line Arguments
+def parse_args():
+    parser = argparse.ArgumentParser(description='Query Click PLC for Modbus coils and register values.')
+    parser.add_argument('plc_ip',help="PLC IP address, or 'list' to list memory types")
+    parser.add_argument('query_type',nargs='?',choices=list(MEM_TABLE) + ['list'],metavar='query_type',
+                        help="memory type to query (%s), or 'list' to list memory types"%(', '.join(MEM_TABLE)))
+    parser.add_argument('--log-file',help='write values to LOG_FILE instead of stdout, files ending in .bin get packed binary records')
+    parser.add_argument('--daemon',action='store_true',help='keep the connection open and scan again every --interval seconds until interrupted')
+    parser.add_argument('--interval',type=float,default=1.0,help='seconds between the start of each daemon scan (default: 1.0)')
+    parser.add_argument('--max-read-registers',type=int,default=max_read_registers,help='most registers per read request, 2 to 125 (default: %(default)s)')
+    parser.add_argument('--max-read-bits',type=int,default=max_read_bits,help='most coils per read request, 1 to 2000 (default: %(default)s)')
+    args = parser.parse_args()
+    # Two register values need at least two registers per request
+    if (args.max_read_registers < 2 or args.max_read_registers > 125):
+        parser.error('--max-read-registers must be between 2 and 125')
+    if (args.max_read_bits < 1 or args.max_read_bits > 2000):
+        parser.error('--max-read-bits must be between 1 and 2000')
+    if (args.interval <= 0):
+        parser.error('--interval must be greater than 0')
+    if (args.plc_ip != 'list' and args.query_type is None):
+        parser.error('a memory type to query is required')
+    return args
+
+# Main
+def main():
+    args     = parse_args()
+    plc_ip   = args.plc_ip
+    plc_port = 502
+    if (plc_ip == 'list' or args.query_type == 'list'):
+        for e in type_names.keys():
+            print('%s: %s'%(e,type_names[e]))
+        sys.exit()
+
+    run_opts = {'daemon':args.daemon,'interval':args.interval,'port':plc_port,
+                'limits':Limits(args.max_read_registers,args.max_read_bits)}
+    try:
+        if (args.log_file is None):
+            status = asyncio.run(run(plc_ip,args.query_type,quiet=stdout_is_null(),**run_opts))
+        elif (args.log_file.endswith('.bin')):
+            with open(args.log_file,'wb',buffering=1<<16) as log:
+                status = asyncio.run(run(plc_ip,args.query_type,log,binary=True,**run_opts))
         else:
-            # Manage non-INT values
-            for b in range(type_ranges[query_type][0],count + 1,reg_sizes[query_type]):
-                if (query_type == 'XD'):
-                    r = client.read_input_registers(start_addr+b,reg_sizes[query_type],unit=0x01)
-                else:
-                    r = client.read_holding_registers(start_addr+b,reg_sizes[query_type],unit=0x01)
-                if r.registers: 
-                    if (query_type in ['DD','CTD','XD','YD']): 
-                        bl = r.registers
-                        # Returned registers contain two byte values and need to be split
-                        a = []
-                        for reg_val in bl:
-                            for v in reg_val.to_bytes(2,'big'):
-                                a.append(v)
-                        rn = int.from_bytes(a,'big',signed=False)
-                        print('%s%s : %s'%(query_type,name_cnt,rn))
-                    # DF values are floats and need to be converted. 
-                    # Bytes to Float Example: https://gregstoll.com/~gregstoll/floattohex/
-                    # NOTE: there are some rounding differences in the PLC, not sure why
-                    if (query_type == 'DF'):
-                        bl = r.registers
-                        # Returned registers contain two byte values and need to be split
-                        a = []
-                        for reg_val in bl:
-                            for v in reg_val.to_bytes(2,'big'):
-                                a.append(v)
-                        fn = struct.unpack('>f',bytearray(a))[0]
-                        print('%s%s : %04f'%(query_type,name_cnt,fn))
-                name_cnt = name_cnt + 1
+            with open(args.log_file,'w') as log:
+                status = asyncio.run(run(plc_ip,args.query_type,log,**run_opts))
+    except KeyboardInterrupt:
+        # Daemon mode runs until interrupted
+        status = 0
+    sys.exit(status)
+
+if __name__ == '__main__':
+    main()